@@ -1,23 +1,35 @@
 import os
 import uuid
+import json
+import shutil
+import hashlib
 import asyncio
+import contextlib
 import httpx
+import aiofiles # Async file I/O so downloads never block the event loop
 from typing import List, Optional
 from datetime import datetime
-from fastapi import FastAPI, Request, BackgroundTasks, HTTPException
-from fastapi.responses import FileResponse
+from urllib.parse import urlparse
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import FileResponse, Response
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel, Field, model_validator # Import model_validator for Pydantic v2
+from PIL import Image
 import logging # New import for logging
 
 # --- Setup Logging ---
+# Level comes from the environment so production runs at INFO (which lets the
+# isEnabledFor(DEBUG) guards actually skip debug-only string building) and
+# LOG_LEVEL=DEBUG turns on the verbose command/filter logging when needed.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+
 # Create a logger instance
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG) # Set to DEBUG to capture all messages
+logger.setLevel(LOG_LEVEL)
 
-# Create console handler and set level to debug
+# Create console handler at the same level
 ch = logging.StreamHandler()
-ch.setLevel(logging.DEBUG)
+ch.setLevel(LOG_LEVEL)
 
 # Create formatter
 formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -40,50 +52,415 @@ app = FastAPI(
 # Setup folders
 CLIP_DIR = "static/clips"
 FINAL_DIR = "static/final"
+IMAGE_CACHE_DIR = "static/clips/images"
 os.makedirs(CLIP_DIR, exist_ok=True)
 os.makedirs(FINAL_DIR, exist_ok=True)
+os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
+
+# Scratch directory for in-flight intermediates (download temp, joined video,
+# voice-over audio). Defaults to tmpfs via /dev/shm where available so these
+# write-once-read-once files never hit the block layer; only served outputs
+# land under static/. Override with WORK_DIR (and size the tmpfs accordingly,
+# e.g. docker --tmpfs /dev/shm:size=2g).
+WORK_DIR = os.environ.get(
+    "WORK_DIR", "/dev/shm/clips" if os.path.isdir("/dev/shm") else "temp_files"
+)
+os.makedirs(WORK_DIR, exist_ok=True)
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
+# --- Shared HTTP Client ---
+# A single module-level client reuses TCP/TLS connections (keep-alive) across
+# requests instead of paying a fresh DNS + handshake per download.
+CLIENT = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=32, keepalive_expiry=60),
+    timeout=30.0,
+)
+
+
+@app.on_event("shutdown")
+async def close_http_client():
+    await CLIENT.aclose()
+    logger.info("Shared HTTP client closed.")
+
+
+# --- Hardware Encoder Detection ---
+# Probed once at startup: NVENC offloads H.264 encoding to the GPU's dedicated
+# ASIC, freeing CPU cores for request handling. Falls back to libx264 when no
+# NVIDIA GPU (or an ffmpeg built without nvenc) is present.
+HAS_NVENC = False
+
+
+@app.on_event("startup")
+async def detect_nvenc():
+    global HAS_NVENC
+    try:
+        process = await asyncio.create_subprocess_exec(
+            FFMPEG_BIN, "-hide_banner", "-encoders",
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        stdout, _ = await process.communicate()
+        HAS_NVENC = process.returncode == 0 and b"h264_nvenc" in stdout
+    except FileNotFoundError:
+        HAS_NVENC = False
+    if not HAS_NVENC:
+        logger.info("h264_nvenc hardware encoder available: False")
+        return
+    # `-encoders` only proves the build was compiled with nvenc; distro
+    # ffmpeg lists it on GPU-less hosts too, where opening the encoder fails
+    # at runtime. Confirm with a one-frame encode before trusting it.
+    try:
+        await run_ffmpeg_command([
+            *hw_device_args(),
+            "-f", "lavfi", "-i", "color=size=64x64:rate=1",
+            "-vf", "format=nv12,hwupload_cuda",
+            "-frames:v", "1",
+            *video_codec_args(),
+            "-f", "null", "-",
+        ])
+    except HTTPException as e:
+        HAS_NVENC = False
+        logger.info(f"h264_nvenc listed by this build but unusable, "
+                    f"falling back to libx264: {e.detail}")
+    logger.info(f"h264_nvenc hardware encoder available: {HAS_NVENC}")
+
+
+@app.on_event("startup")
+async def warm_ffmpeg():
+    """
+    Runs a one-frame throwaway encode at startup. The first ffmpeg fork pays
+    for dynamic-linking libavcodec/libswscale/libx264 and pulling them into
+    the page cache; doing it here means no user request eats that cost.
+    """
+    try:
+        await run_ffmpeg_command([
+            "-f", "lavfi", "-i", "color=size=64x64:rate=1",
+            "-frames:v", "1",
+            *video_codec_args(still_image=True),
+            "-f", "null", "-",
+        ])
+        logger.info("FFmpeg warm-up encode completed.")
+    except HTTPException as e:
+        # Warm-up is best-effort; a failure here must not stop the app.
+        logger.warning(f"FFmpeg warm-up encode failed: {e.detail}")
+
+
+def video_codec_args(still_image: bool = False) -> List[str]:
+    """
+    Returns the H.264 encoder arguments for the detected hardware:
+    h264_nvenc when an NVIDIA GPU is available, libx264 otherwise.
+    Pass `still_image=True` for single-still sources so libx264 can skip
+    motion-estimation work sized for live action (NVENC has no stillimage
+    tune; it uses its high-quality tune there). Note NVENC takes its own
+    preset names (p1-p7), not libx264 ones.
+    """
+    if HAS_NVENC:
+        # -b:v 0 lets constant-quality vbr pick the bitrate entirely from -cq
+        return ["-c:v", "h264_nvenc", "-preset", "p4", "-tune", "hq", "-rc", "vbr", "-cq", "23", "-b:v", "0"]
+    tune = "stillimage" if still_image else "film"
+    return ["-c:v", "libx264", "-preset", "veryfast", "-tune", tune, "-crf", "23",
+            "-threads", str(ENCODER_THREADS)]
+
+
+async def download_file(url: str, dest_path: str) -> str:
+    """
+    Streams a remote file to disk using the shared HTTP client.
+    Returns the SHA-256 hex digest of the downloaded bytes (hashed
+    incrementally while streaming, so it costs no extra pass).
+    Raises httpx.HTTPStatusError on bad status codes.
+    """
+    digest = hashlib.sha256()
+    async with CLIENT.stream("GET", url) as response:
+        response.raise_for_status()
+        async with aiofiles.open(dest_path, "wb") as f:
+            async for chunk in response.aiter_bytes(1 << 16):
+                digest.update(chunk)
+                await f.write(chunk)
+    return digest.hexdigest()
+
+
+# --- Downloaded-Image Dedup Index ---
+# Images are stored once per unique content hash; requests reusing the same
+# stock image (even via different URLs) share a single on-disk copy, and a
+# repeated URL skips the HTTP fetch entirely. The digest->path index is
+# persisted as JSON so it survives restarts; the URL->digest map is memory-only
+# since a URL's content can change between runs.
+IMAGE_INDEX_PATH = os.path.join(IMAGE_CACHE_DIR, "index.json")
+try:
+    with open(IMAGE_INDEX_PATH) as _f:
+        IMAGE_INDEX = json.load(_f)
+except (FileNotFoundError, json.JSONDecodeError):
+    IMAGE_INDEX = {}
+URL_DIGESTS: dict = {}
+
+
+def _persist_image_index():
+    try:
+        with open(IMAGE_INDEX_PATH, "w") as f:
+            json.dump(IMAGE_INDEX, f)
+    except OSError as e:
+        logger.error(f"Could not persist image index: {e}")
+
+
+# Cap on stored source images so the dedup cache cannot grow without bound
+# on a long-lived instance. Eviction is FIFO over the index's insertion
+# order — the oldest downloads go first.
+IMAGE_CACHE_MAX_ENTRIES = int(os.environ.get("IMAGE_CACHE_MAX_ENTRIES", "256"))
+
+
+def _evict_image_cache():
+    """Drops index entries beyond the cap and unlinks their files. Blocking;
+    called via asyncio.to_thread. Stale URL_DIGESTS mappings are harmless:
+    fetch_image re-checks the file exists before trusting them."""
+    while len(IMAGE_INDEX) > IMAGE_CACHE_MAX_ENTRIES:
+        digest, path = next(iter(IMAGE_INDEX.items()))
+        del IMAGE_INDEX[digest]
+        try:
+            os.remove(path)
+        except OSError as e:
+            logger.error(f"Error evicting cached image {path}: {e}")
+        logger.info(f"Evicted image {digest[:12]}... from the dedup cache")
+
+
+async def fetch_image(url: str) -> tuple[str, str]:
+    """
+    Returns (local_path, sha256_digest) for the image at `url`, downloading
+    only when the content is not already in the dedup cache.
+    """
+    digest = URL_DIGESTS.get(url)
+    if digest:
+        cached = IMAGE_INDEX.get(digest)
+        if cached and os.path.exists(cached):
+            logger.info(f"Image cache hit for {url} (sha256 {digest[:12]}...), skipping download.")
+            return cached, digest
+
+    tmp_path = os.path.join(WORK_DIR, f"dl_{uuid.uuid4().hex}.img")
+    digest = await download_file(url, tmp_path)
+
+    canonical = IMAGE_INDEX.get(digest)
+    if canonical and os.path.exists(canonical):
+        # Same bytes already on disk (possibly fetched via another URL)
+        await asyncio.to_thread(os.remove, tmp_path)
+        logger.info(f"Downloaded image deduplicated against existing copy {canonical}")
+    else:
+        canonical = os.path.join(IMAGE_CACHE_DIR, f"{digest}.img")
+        # Staged publish, not a direct move: two concurrent requests for the
+        # same uncached image can both reach here, and a cross-filesystem
+        # move straight onto the canonical path would let the second writer
+        # truncate the file while the first is already reading it. With the
+        # stage-and-rename, the canonical path only ever holds a complete
+        # copy, and both writers carry identical bytes so losing the rename
+        # race is harmless.
+        await publish_output(tmp_path, canonical)
+        IMAGE_INDEX[digest] = canonical
+        await asyncio.to_thread(_evict_image_cache)
+        _persist_image_index()
+
+    URL_DIGESTS[url] = digest
+    return canonical, digest
+
 # --- Pydantic Models for Request Body ---
 class GenerateClipRequest(BaseModel):
     """
     Request body for generating a single video clip from an image.
     """
     image_url: str = Field(..., description="URL of the image (576x1024 recommended) to use for the clip.")
-    length: float = Field(5.0, gt=0, description="Duration of the video clip in seconds.")
-    frame_rate: int = Field(25, gt=0, description="Frames per second of the output video.")
-    max_zoom: float = Field(1.25, ge=1.0, description="Maximum zoom factor. Image starts at 1/max_zoom and grows to 1.0.")
+    length: float = Field(5.0, ge=0.1, le=60, description="Duration of the video clip in seconds.")
+    frame_rate: int = Field(25, ge=1, le=120, description="Frames per second of the output video.")
+    max_zoom: float = Field(1.25, ge=1.0, le=4.0, description="Maximum zoom factor. Image starts at 1/max_zoom and grows to 1.0.")
 
 
-# --- Helper Function to Run FFmpeg (Async) ---
-async def run_ffmpeg_command(command: list[str]):
+# The zoompan "grow" filter as a single module-level template. Every value
+# interpolated into it is a number that has passed the Field bounds above, so
+# the filter graph can never be malformed (or injected into) by request input.
+# The zoom samples from a canvas exactly twice the output size: big enough for
+# sub-pixel smoothness at max_zoom, small enough (~3.7 MP regardless of
+# source resolution) that the per-frame working set stays cache-friendly.
+# scale+crop normalises any source aspect onto that canvas first. The grow is
+# zoompan ramping z linearly per output frame (`on`); crop's w/h expressions
+# are only evaluated at filter configuration, so an animated crop window
+# cannot express this, and z values are clamped below 1.0 so the ramp must
+# start there and grow.
+ZOOM_TEMPLATE = (
+    "scale={pre_width}:{pre_height}:force_original_aspect_ratio=increase:flags=lanczos,"
+    "crop={pre_width}:{pre_height},"
+    "zoompan=z='1+{z_rate:.8f}*on':x='iw/2-(iw/zoom/2)':y='ih/2-(ih/zoom/2)'"
+    ":d=1:s={width}x{height}:fps={fps}"
+)
+
+# Output resolution for standard Reels (9:16 aspect ratio)
+OUTPUT_WIDTH = 720
+OUTPUT_HEIGHT = 1280
+
+
+# Reject images whose raw pixel buffer would be absurd (e.g. 20000x15000):
+# the pre-scale allocates memory proportional to source resolution, so a
+# pathological input could OOM the container before ffmpeg even starts.
+MAX_IMAGE_PIXELS = 40_000_000
+
+
+def validate_image(path: str) -> tuple[int, int]:
     """
-    Executes an FFmpeg command asynchronously.
-    Raises HTTPException if FFmpeg returns a non-zero exit code.
+    Reads the image header (no pixel decode) and returns (width, height).
+    Raises HTTPException for files that are not images or are absurdly large.
+    """
+    try:
+        with Image.open(path) as im:
+            width, height = im.size
+    except Exception:
+        logger.error(f"Downloaded file is not a readable image: {path}")
+        raise HTTPException(status_code=422, detail="Downloaded file is not a valid image")
+    if width * height > MAX_IMAGE_PIXELS:
+        logger.error(f"Rejected image with excessive dimensions {width}x{height}: {path}")
+        raise HTTPException(status_code=422, detail=f"Image dimensions {width}x{height} exceed the allowed pixel budget")
+    return width, height
+
+
+def build_zoom_filter(duration: float, frame_rate: int, max_zoom: float) -> str:
+    """
+    Builds the complete grow-effect filter chain for one clip, including the
+    pixel-format tail (VRAM upload on the NVENC path, yuv420p otherwise).
+    The zoom reaches max_zoom on the clip's last frame.
+    """
+    total_frames = int(duration * frame_rate)
+    zoom_rate = (max_zoom - 1.0) / max(total_frames - 1, 1)
+    expr = ZOOM_TEMPLATE.format(
+        pre_width=OUTPUT_WIDTH * 2,
+        pre_height=OUTPUT_HEIGHT * 2,
+        z_rate=zoom_rate,
+        width=OUTPUT_WIDTH,
+        height=OUTPUT_HEIGHT,
+        fps=frame_rate,
+    )
+    if HAS_NVENC:
+        # zoompan has no CUDA implementation, so the zoom itself stays on CPU;
+        # frames are uploaded to VRAM once here and stay there through NVENC.
+        return expr + ",format=nv12,hwupload_cuda"
+    return expr + ",format=yuv420p"
+
+
+def hw_device_args() -> List[str]:
+    """CUDA filter-device flags, required whenever the chain uses hwupload_cuda."""
+    if HAS_NVENC:
+        return ["-init_hw_device", "cuda=cu:0", "-filter_hw_device", "cu"]
+    return []
+
+
+# Canonical stream parameters stamped onto every generated clip. Clips that
+# share profile/level/timescale (on top of codec, resolution and pix_fmt) can
+# be concatenated with `-c copy` in /join-clips — no re-encode of the joined
+# video, regardless of which request produced each clip.
+CANONICAL_STREAM_ARGS = [
+    "-profile:v", "high",
+    "-level", "4.0",
+    "-video_track_timescale", "15360",
+]
+
+# -movflags +faststart rewrites the entire file after encoding to move the
+# moov atom to the head — a second full read+write pass. Generated clips are
+# written as fragmented MP4 instead: streamable from byte zero, produced in a
+# single pass. Final /join-clips outputs keep +faststart since those are the
+# files consumers download and plain-MP4 compatibility matters most there.
+FRAGMENTED_MP4_FLAGS = "empty_moov+frag_keyframe+default_base_moof"
+
+
+async def probe_stream_params(path: str) -> dict:
+    """
+    Returns the video-stream parameters relevant to `-c copy` concat safety
+    for the given file, via ffprobe.
     """
-    logger.info(f"Attempting to execute FFmpeg command: {' '.join(command)}")
     try:
         process = await asyncio.create_subprocess_exec(
-            "ffmpeg", # This is the command that needs to be in PATH
-            *command,
+            FFPROBE_BIN, "-v", "error", "-select_streams", "v:0",
+            "-show_entries", "stream=codec_name,width,height,pix_fmt,r_frame_rate",
+            "-of", "json", path,
             stdout=asyncio.subprocess.PIPE,
             stderr=asyncio.subprocess.PIPE
         )
         stdout, stderr = await process.communicate()
+    except FileNotFoundError:
+        logger.critical("ffprobe executable not found. Please ensure FFmpeg is installed and in your system's PATH.")
+        raise HTTPException(status_code=500, detail="ffprobe not found. Is FFmpeg installed and in your PATH?")
+    if process.returncode != 0:
+        logger.error(f"ffprobe failed for {path}: {stderr.decode(errors='ignore')}")
+        raise HTTPException(status_code=422, detail=f"Could not probe input clip: {path}")
+    streams = json.loads(stdout.decode()).get("streams", [])
+    if not streams:
+        raise HTTPException(status_code=422, detail=f"No video stream found in input clip: {path}")
+    return streams[0]
+
+
+async def has_audio_stream(path: str) -> bool:
+    """Returns True when the file carries at least one audio stream, via ffprobe."""
+    process = await asyncio.create_subprocess_exec(
+        FFPROBE_BIN, "-v", "error", "-select_streams", "a",
+        "-show_entries", "stream=index", "-of", "json", path,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    stdout, _ = await process.communicate()
+    if process.returncode != 0:
+        return False
+    return bool(json.loads(stdout.decode()).get("streams"))
+
+
+# Resolve the binaries once at import: every create_subprocess_exec with a
+# bare name repeats the execvp PATH walk, and the absolute path lets repeated
+# forks hit the same inode. The bare names stay as fallback so the usual
+# "is ffmpeg installed?" error path still fires on first use.
+FFMPEG_BIN = shutil.which("ffmpeg") or "ffmpeg"
+FFPROBE_BIN = shutil.which("ffprobe") or "ffprobe"
+
+
+# Cap concurrent ffmpeg jobs so a burst of requests can't oversubscribe the
+# host: each encode already parallelises internally, so running more jobs than
+# cores just thrashes. Waiting requests queue on the semaphore without
+# blocking the event loop. Encoder threads are pinned explicitly so the
+# encoder sizes its thread pool to the vCPUs it can actually get, instead of
+# guessing while several jobs fight over the same cores.
+MAX_CONCURRENT_JOBS = min(os.cpu_count() or 1, 4)
+FFMPEG_SEMAPHORE = asyncio.Semaphore(MAX_CONCURRENT_JOBS)
+ENCODER_THREADS = os.cpu_count() or 1
+
+
+# --- Helper Function to Run FFmpeg (Async) ---
+async def run_ffmpeg_command(command: list[str], input_data: Optional[bytes] = None):
+    """
+    Executes an FFmpeg command asynchronously, optionally feeding
+    `input_data` to its stdin (e.g. a concat list via `-i pipe:0`).
+    Raises HTTPException if FFmpeg returns a non-zero exit code.
+    """
+    # Joining the full command allocates a potentially large string per run,
+    # so it only happens when debug logging is actually on.
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Executing FFmpeg command: %s", " ".join(command))
+    try:
+        async with FFMPEG_SEMAPHORE:
+            process = await asyncio.create_subprocess_exec(
+                FFMPEG_BIN, # Absolute path resolved at import when possible
+                # Errors only, no progress stats: cuts stderr volume ~100x so
+                # a verbose encode never streams megabytes back through the pipe.
+                "-hide_banner", "-loglevel", "error", "-nostats",
+                *command,
+                stdin=asyncio.subprocess.PIPE if input_data is not None else None,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+            stdout, stderr = await process.communicate(input_data)
 
         if process.returncode != 0:
-            error_message = (
+            # Only the last 4 KB of stderr is kept; with -loglevel error that
+            # always contains the actual failure.
+            stderr_tail = stderr[-4096:].decode(errors="replace")
+            logger.error(
                 f"FFmpeg command failed with exit code {process.returncode}.\n"
-                f"STDOUT:\n{stdout.decode(errors='ignore')}\n"
-                f"STDERR:\n{stderr.decode(errors='ignore')}"
+                f"STDERR tail:\n{stderr_tail}"
             )
-            logger.error(error_message) # Log the full FFmpeg error for debugging
-            raise HTTPException(status_code=500, detail=f"FFmpeg command failed. See server logs for details.")
-        
+            raise HTTPException(status_code=500, detail=f"FFmpeg command failed: {stderr_tail}")
+
         logger.info(f"FFmpeg command executed successfully.")
-        logger.debug(f"FFmpeg STDOUT: {stdout.decode(errors='ignore')}")
-        logger.debug(f"FFmpeg STDERR: {stderr.decode(errors='ignore')}")
 
     except FileNotFoundError: # This specifically catches [Errno 2] if 'ffmpeg' isn't found
         logger.critical("FFmpeg executable not found. Please ensure FFmpeg is installed and in your system's PATH.")
@@ -93,24 +470,85 @@ async def run_ffmpeg_command(command: list[str]):
         raise HTTPException(status_code=500, detail=f"An internal server error occurred: {e}")
 
 
-def delete_files(paths: List[str], delay=3600):
+async def _delete_files(paths: List[str]):
     """
-    Deletes files from the given paths after a specified delay.
-    This is intended to clean up temporary files generated by the application.
+    Deletes a batch of files, pushing the blocking unlink syscalls onto a
+    worker thread so the event loop never stalls on disk. Must never raise:
+    it runs as fire-and-forget cleanup.
     """
-    time.sleep(delay)
     for path in paths:
         try:
             if os.path.exists(path):
-                os.remove(path)
+                await asyncio.to_thread(os.remove, path)
                 logger.info(f"Cleaned up temporary file: {path}")
             else:
                 logger.warning(f"Attempted to delete non-existent file: {path}")
         except Exception as e:
             logger.error(f"Error deleting {path}: {e}")
 
+
+# One pending deletion timer per path. Re-scheduling a path cancels its old
+# timer first, so a cache hit can push the file's expiry out instead of
+# serving a URL whose deletion from an earlier request is about to fire.
+_DELETE_TIMERS: dict = {}
+
+
+def schedule_delete(paths: List[str], delay: float = 3600):
+    """
+    Schedules each file for deletion after `delay` seconds using an
+    event-loop timer. Unlike a BackgroundTask that sleeps, this holds no
+    thread from the Starlette pool while waiting. Re-scheduling an
+    already-pending path resets its timer to the new deadline.
+    """
+    loop = asyncio.get_running_loop()
+
+    def _fire(path: str):
+        _DELETE_TIMERS.pop(path, None)
+        loop.create_task(_delete_files([path]))
+
+    for path in paths:
+        existing = _DELETE_TIMERS.pop(path, None)
+        if existing is not None:
+            existing.cancel()
+        _DELETE_TIMERS[path] = loop.call_later(delay, _fire, path)
+    logger.info(f"Scheduled cleanup in {delay}s for {paths}")
+
+
+# Per-cache-key locks so concurrent requests for the same image+params don't
+# encode the same output twice: the first holds the lock while encoding, the
+# rest re-check the cache after acquiring it and get a hit. Entries are
+# refcounted and dropped when the last user releases, so the table tracks
+# in-flight keys only instead of growing by one Lock per key forever.
+_CACHE_LOCKS: dict = {}  # cache_key -> [asyncio.Lock, user count]
+
+
+@contextlib.asynccontextmanager
+async def cache_lock(cache_key: str):
+    entry = _CACHE_LOCKS.setdefault(cache_key, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            _CACHE_LOCKS.pop(cache_key, None)
+
+
+async def publish_output(tmp_path: str, final_path: str):
+    """
+    Moves a finished scratch file (an encode or a downloaded image) into its
+    content-addressed cache path. The bytes are copied onto the cache
+    filesystem under a staging name first (in a worker thread — WORK_DIR is
+    usually tmpfs, so this crosses filesystems) and then renamed into place,
+    so a concurrent reader only ever sees a complete file at the cache path.
+    """
+    staging_path = f"{final_path}.{uuid.uuid4().hex}.part"
+    await asyncio.to_thread(shutil.move, tmp_path, staging_path)
+    os.replace(staging_path, final_path)
+
 @app.post("/generate-clip", summary="Generate a TikTok-style video clip from an image")
-async def generate_clip_endpoint(request_data: GenerateClipRequest, background_tasks: BackgroundTasks):
+async def generate_clip_endpoint(request_data: GenerateClipRequest):
     """
     Generates a vertical video clip (suitable for TikTok/Reels) from a single image.
     The image will grow smoothly to fill the 9:16 frame.
@@ -126,79 +564,90 @@ async def generate_clip_endpoint(request_data: GenerateClipRequest, background_t
     duration = request_data.length
     frame_rate = request_data.frame_rate
     max_grow_factor = request_data.max_zoom
-    
-    # --- Output video resolution for standard Reels (9:16 aspect ratio) ---
-    output_width = 720
-    output_height = 1280
 
-    # Calculate the initial zoom level. Image will start at this scale (e.g., 0.8).
-    initial_zoom_level = 1.0 / max_grow_factor
-    
-    # Define the end zoom level, which is 1.0 (image fills its designated space).
-    zoom_end_level = 1.0
-    
-    # Calculate total frames for the zoompan duration parameter.
+    # Calculate total frames for the encode budget.
     total_frames = int(duration * frame_rate)
 
-    timestamp = datetime.now().isoformat().replace(":", "-").replace(".", "-")
-    input_image = os.path.join(CLIP_DIR, f"{timestamp}.jpg")
-    output_video = os.path.join(CLIP_DIR, f"{timestamp}.mp4")
-
-    # Add files to cleanup in background task
-    files_to_delete = [input_image, output_video]
-    background_tasks.add_task(delete_files, files_to_delete, delay=3600)
-    logger.info(f"Scheduled cleanup for {files_to_delete}")
+    # Restrict the scheme so a request can't point the fetcher at local files
+    # or exotic protocols.
+    if urlparse(image_url).scheme.lower() not in ("http", "https"):
+        logger.error(f"Rejected image_url with disallowed scheme: {image_url}")
+        raise HTTPException(status_code=422, detail="image_url must use http or https")
 
     try:
-        # Download image using httpx (asynchronous)
-        logger.info(f"Downloading image from {image_url} to {input_image}")
-        async with httpx.AsyncClient() as client:
-            response = await client.get(image_url)
-            response.raise_for_status() # Raise an exception for bad status codes
-            with open(input_image, "wb") as f:
-                f.write(response.content)
-        logger.info(f"Image downloaded successfully to {input_image}. File size: {os.path.getsize(input_image)} bytes.")
-
-        # Validate if the image was downloaded successfully
-        if not os.path.exists(input_image) or os.path.getsize(input_image) < 1024:
-            logger.error(f"Downloaded image is invalid or too small: {input_image}")
-            raise HTTPException(status_code=422, detail="Invalid image or download failed")
-
-        # FFmpeg filter complex for a stable "grow" effect without cutting, outputting 720x1280.
-        zoom_expr = (
-            f"scale=8000:-1,"
-            f"zoompan=z='({initial_zoom_level:.6f} + (({zoom_end_level:.6f} - {initial_zoom_level:.6f}) / {duration:.6f}) * t)':x='iw/2-(iw/zoom/2)':y='ih/2-(ih/zoom/2)':d={total_frames}:s={output_width}x{output_height}"
+        # Fetch via the dedup cache; repeated content is downloaded only once.
+        input_image, image_digest = await fetch_image(image_url)
+        source_width, source_height = validate_image(input_image)
+        logger.info(f"Using image {input_image} ({source_width}x{source_height}). File size: {os.path.getsize(input_image)} bytes.")
+
+        # Content-addressed output path: the same image bytes with the same
+        # parameters always map to the same file, so a repeat request serves
+        # the cached clip instead of re-encoding.
+        params_key = json.dumps(
+            {"l": duration, "f": frame_rate, "z": max_grow_factor}, sort_keys=True
         )
-        logger.debug(f"FFmpeg zoompan filter expression: {zoom_expr}")
-
-        # FFmpeg command to create the video clip
-        cmd = [
-            "-y", # Overwrite output files without asking
-            "-loop", "1", # Loop the input image
-            "-i", input_image,
-            "-vf", zoom_expr, # Apply the combined video filter graph
-            "-t", str(duration), # Set the duration of the output video
-            "-r", str(frame_rate), # Set the frame rate
-            "-pix_fmt", "yuv420p", # Set pixel format for broader compatibility
-            "-c:v", "libx264", # Explicitly set video codec for web compatibility
-            "-preset", "medium", # Good balance of speed and quality
-            "-crf", "23", # Constant Rate Factor for quality control
-            "-movflags", "+faststart", # For web streaming optimization
-            output_video
-        ]
+        cache_key = hashlib.sha256(f"{image_digest}:{params_key}".encode()).hexdigest()
+        output_video = os.path.join(CLIP_DIR, f"{cache_key}.mp4")
 
-        await run_ffmpeg_command(cmd)
-        logger.info(f"Video clip generated: {output_video}. File exists: {os.path.exists(output_video)}. File size: {os.path.getsize(output_video)} bytes.")
+        async with cache_lock(cache_key):
+            if os.path.exists(output_video) and os.path.getsize(output_video) > 0:
+                logger.info(f"Cache hit for {cache_key}, skipping encode.")
+                # Re-arm the TTL so the URL we hand out stays valid for a
+                # full window from now, not from the original encode.
+                schedule_delete([output_video])
+                return {
+                    "clip_path": output_video,
+                    "public_url": f"/static/clips/{os.path.basename(output_video)}",
+                    "cached": True,
+                }
 
+            # FFmpeg filter chain for a stable "grow" effect without cutting, outputting 720x1280.
+            zoom_expr = build_zoom_filter(duration, frame_rate, max_grow_factor)
+            logger.debug(f"FFmpeg zoompan filter expression: {zoom_expr}")
 
-        # Check if video generation was successful
-        if not os.path.exists(output_video) or os.path.getsize(output_video) == 0:
-            logger.error(f"Output video file not created or is empty: {output_video}")
-            raise HTTPException(status_code=500, detail="Video generation failed: Output file not created or is empty.")
+            # Encode to scratch, then publish into the cache path atomically.
+            tmp_video = os.path.join(WORK_DIR, f"enc_{uuid.uuid4().hex}.mp4")
+
+            # FFmpeg command to create the video clip
+            cmd = [
+                "-y", # Overwrite output files without asking
+                *hw_device_args(), # CUDA filter device when NVENC is in use
+                "-sws_flags", "lanczos", # High-quality scaling inside zoompan as well
+                "-framerate", str(frame_rate), # Input timestamps at the target rate
+                "-loop", "1", # Loop the input image
+                "-i", input_image,
+                "-vf", zoom_expr, # Apply the combined video filter graph
+                "-frames:v", str(total_frames), # Exact frame budget; stops encode precisely
+                *video_codec_args(still_image=True), # NVENC when available, libx264 otherwise
+                *CANONICAL_STREAM_ARGS, # Identical stream params keep concat -c copy safe
+                "-g", str(frame_rate), # One keyframe per second for quick seeking
+                "-movflags", FRAGMENTED_MP4_FLAGS, # Streamable in one pass; no moov rewrite
+                tmp_video
+            ]
+
+            try:
+                await run_ffmpeg_command(cmd)
+
+                # Check if video generation was successful
+                if not os.path.exists(tmp_video) or os.path.getsize(tmp_video) == 0:
+                    logger.error(f"Output video file not created or is empty: {tmp_video}")
+                    raise HTTPException(status_code=500, detail="Video generation failed: Output file not created or is empty.")
+
+                await publish_output(tmp_video, output_video)
+            finally:
+                # publish_output moves the temp away on success; anything
+                # left is a failed encode's partial output.
+                if os.path.exists(tmp_video):
+                    await _delete_files([tmp_video])
+            # Schedule cleanup on the event loop. The input image stays: it
+            # lives in the dedup cache and may serve other requests.
+            schedule_delete([output_video])
+        logger.info(f"Video clip generated: {output_video}. File size: {os.path.getsize(output_video)} bytes.")
 
         response_payload = {
             "clip_path": output_video,
-            "public_url": f"/static/clips/{os.path.basename(output_video)}"
+            "public_url": f"/static/clips/{os.path.basename(output_video)}",
+            "cached": False,
         }
         logger.info(f"Successfully generated clip. Response: {response_payload}")
         return response_payload
@@ -213,6 +662,125 @@ async def generate_clip_endpoint(request_data: GenerateClipRequest, background_t
         raise HTTPException(status_code=500, detail=f"An internal server error occurred during clip generation: {e}")
 
 
+class GenerateClipsRequest(BaseModel):
+    """
+    Request body for generating several video clips in one batch.
+    """
+    clips: List[GenerateClipRequest] = Field(..., min_items=1, description="Specs of the clips to generate, one output video per entry.")
+
+
+@app.post("/generate-clips", summary="Generate several clips with a single FFmpeg invocation")
+async def generate_clips_endpoint(request_data: GenerateClipsRequest):
+    """
+    Generates N clips with one ffmpeg process instead of N: each clip becomes
+    an input plus a branch in a single -filter_complex graph, mapped to its
+    own output file. Process startup and codec initialisation are paid once
+    for the whole batch, and ffmpeg's internal thread pool schedules the
+    branches concurrently. Per-clip caching works exactly as in /generate-clip.
+    """
+    logger.info(f"Received request to generate {len(request_data.clips)} clips in one batch.")
+
+    for spec in request_data.clips:
+        if urlparse(spec.image_url).scheme.lower() not in ("http", "https"):
+            logger.error(f"Rejected image_url with disallowed scheme: {spec.image_url}")
+            raise HTTPException(status_code=422, detail="image_url must use http or https")
+
+    try:
+        # Fetch all images concurrently; the shared client pools connections,
+        # so N clips cost roughly one download round-trip instead of N.
+        fetched = await asyncio.gather(
+            *(fetch_image(spec.image_url) for spec in request_data.clips)
+        )
+
+        # Deduplicate by cache key first: two identical specs in one batch
+        # must not both map to the same output file in one ffmpeg run (the
+        # second -map would clobber the first mid-write).
+        unique = {}  # cache_key -> (spec, input_image, output_video)
+        order = []   # cache_keys in request order, duplicates included
+        for spec, (input_image, image_digest) in zip(request_data.clips, fetched):
+            validate_image(input_image)
+            params_key = json.dumps(
+                {"l": spec.length, "f": spec.frame_rate, "z": spec.max_zoom}, sort_keys=True
+            )
+            cache_key = hashlib.sha256(f"{image_digest}:{params_key}".encode()).hexdigest()
+            output_video = os.path.join(CLIP_DIR, f"{cache_key}.mp4")
+            order.append(cache_key)
+            unique.setdefault(cache_key, (spec, input_image, output_video))
+
+        # Same guard as /generate-clip, taken for every key in the batch.
+        # Sorted acquisition keeps two overlapping batches from deadlocking
+        # on each other's keys.
+        cached_keys = set()
+        pending = []  # (spec, input_image, output_video, tmp_video) for cache misses
+        try:
+            async with contextlib.AsyncExitStack() as lock_stack:
+                for key in sorted(unique):
+                    await lock_stack.enter_async_context(cache_lock(key))
+                for key, (spec, input_image, output_video) in unique.items():
+                    if os.path.exists(output_video) and os.path.getsize(output_video) > 0:
+                        cached_keys.add(key)
+                        schedule_delete([output_video])  # re-arm the TTL on the hit
+                    else:
+                        tmp_video = os.path.join(WORK_DIR, f"enc_{uuid.uuid4().hex}.mp4")
+                        pending.append((spec, input_image, output_video, tmp_video))
+
+                if pending:
+                    cmd = ["-y", *hw_device_args(), "-sws_flags", "lanczos"]
+                    filter_parts = []
+                    for i, (spec, input_image, _, _) in enumerate(pending):
+                        cmd += ["-framerate", str(spec.frame_rate), "-loop", "1", "-i", input_image]
+                        filter_parts.append(
+                            f"[{i}:v]{build_zoom_filter(spec.length, spec.frame_rate, spec.max_zoom)}[v{i}]"
+                        )
+                    cmd += ["-filter_complex", ";".join(filter_parts)]
+                    for i, (spec, _, _, tmp_video) in enumerate(pending):
+                        cmd += [
+                            "-map", f"[v{i}]",
+                            "-frames:v", str(int(spec.length * spec.frame_rate)),
+                            *video_codec_args(still_image=True),
+                            *CANONICAL_STREAM_ARGS,
+                            "-g", str(spec.frame_rate),
+                            "-movflags", FRAGMENTED_MP4_FLAGS,
+                            tmp_video,
+                        ]
+
+                    await run_ffmpeg_command(cmd)
+
+                    for _, _, _, tmp_video in pending:
+                        if not os.path.exists(tmp_video) or os.path.getsize(tmp_video) == 0:
+                            logger.error(f"Output video file not created or is empty: {tmp_video}")
+                            raise HTTPException(status_code=500, detail="Video generation failed: Output file not created or is empty.")
+                    for _, _, output_video, tmp_video in pending:
+                        await publish_output(tmp_video, output_video)
+                        schedule_delete([output_video])
+        finally:
+            # Published temps were moved away; anything left is a failed
+            # encode's partial output on the scratch filesystem.
+            leftovers = [t for _, _, _, t in pending if os.path.exists(t)]
+            if leftovers:
+                await _delete_files(leftovers)
+
+        results = []
+        for key in order:
+            _, _, output_video = unique[key]
+            results.append({
+                "clip_path": output_video,
+                "public_url": f"/static/clips/{os.path.basename(output_video)}",
+                "cached": key in cached_keys,
+            })
+        logger.info(f"Successfully generated batch of {len(results)} clips ({len(pending)} encoded, {len(unique) - len(pending)} cached).")
+        return {"clips": results}
+
+    except httpx.HTTPStatusError as e:
+        logger.error(f"HTTP error during image download: {e.response.status_code} - {e.response.text}", exc_info=True)
+        raise HTTPException(status_code=e.response.status_code, detail=f"Failed to download image from URL: {e.response.status_code} - {e.response.text}")
+    except HTTPException: # Re-raise FastAPI HTTPExceptions
+        raise
+    except Exception as e:
+        logger.exception(f"An unhandled error occurred during batch clip generation: {e}")
+        raise HTTPException(status_code=500, detail=f"An internal server error occurred during batch clip generation: {e}")
+
+
 # --- Pydantic Models for Request Body ---
 class ClipInfo(BaseModel):
     filename: str = Field(..., description="Path/filename of the existing video clip.")
@@ -236,25 +804,91 @@ class ProcessClipsRequest(BaseModel):
     output_filename: Optional[str] = Field(None, description="Desired name for the output video file. If not provided, a UUID will be generated.")
 
 
+def _format_srt_time(seconds: float) -> str:
+    """Formats seconds as the SRT timestamp form HH:MM:SS,mmm."""
+    millis = int(round(seconds * 1000))
+    hours, rem = divmod(millis, 3_600_000)
+    minutes, rem = divmod(rem, 60_000)
+    secs, millis = divmod(rem, 1000)
+    return f"{hours:02d}:{minutes:02d}:{secs:02d},{millis:03d}"
+
+
+# Two cues with the same text this close together (seconds) render as one
+COALESCE_GAP = 0.05
+
+
+def _srt_text(text: str) -> str:
+    """
+    Normalizes user caption text for use as an SRT cue body. A blank line
+    terminates a cue in SRT, so stray carriage returns and empty lines in the
+    text would end the cue early and leave the rest parsed as garbage
+    (or as attacker-chosen extra cues). Multi-line captions stay multi-line.
+    """
+    lines = [line.strip() for line in text.replace("\r", "").split("\n")]
+    return "\n".join(line for line in lines if line)
+
+
+def build_srt(captions: List[SubtitleEntry]) -> str:
+    """
+    Renders the caption entries as an SRT document for the subtitles filter.
+    Entries are sorted by start time and consecutive cues with identical text
+    whose windows touch (within COALESCE_GAP) are merged, so the renderer
+    holds one cue instead of flickering through several.
+    """
+    merged: List[List] = []  # [start_time, end_time, text]
+    for caption in sorted(captions, key=lambda c: c.start_time):
+        text = _srt_text(caption.text)
+        if not text:
+            continue
+        if (merged and text == merged[-1][2]
+                and caption.start_time - merged[-1][1] <= COALESCE_GAP):
+            merged[-1][1] = max(merged[-1][1], caption.end_time)
+        else:
+            merged.append([caption.start_time, caption.end_time, text])
+
+    blocks = []
+    for i, (start_time, end_time, text) in enumerate(merged, start=1):
+        blocks.append(
+            f"{i}\n"
+            f"{_format_srt_time(start_time)} --> {_format_srt_time(end_time)}\n"
+            f"{text}\n"
+        )
+    return "\n".join(blocks)
+
+
 @app.post("/join-clips", summary="Join clips, add audio, and captions")
-async def join_clips_endpoint(request_data: ProcessClipsRequest, background_tasks: BackgroundTasks):
+async def join_clips_endpoint(request_data: ProcessClipsRequest):
     """
     Joins multiple video clips, optionally adds an audio track and captions,
     and outputs a final video.
     """
     logger.info(f"Received request to join clips.")
     
+    # Voice-over audio is read by ffmpeg straight from its URL (built-in https
+    # protocol) — no pre-download pass. Vet the scheme, then a cheap HEAD:
+    # without it a dead link only surfaces after the concat pass as a generic
+    # 500 from the ffmpeg stderr tail, instead of the upstream 4xx here.
+    if request_data.audio_url:
+        if urlparse(request_data.audio_url).scheme.lower() not in ("http", "https"):
+            logger.error(f"Rejected audio_url with disallowed scheme: {request_data.audio_url}")
+            raise HTTPException(status_code=422, detail="audio_url must use http or https")
+        try:
+            head_response = await CLIENT.head(request_data.audio_url, follow_redirects=True)
+            head_response.raise_for_status()
+        except httpx.HTTPStatusError as e:
+            logger.error(f"audio_url rejected by upstream: {e.response.status_code}")
+            raise HTTPException(status_code=e.response.status_code, detail=f"Failed to fetch audio from URL: {e.response.status_code}")
+        except httpx.RequestError as e:
+            logger.error(f"audio_url unreachable: {e}")
+            raise HTTPException(status_code=422, detail=f"Could not reach audio_url: {e}")
+
     timestamp = datetime.now().isoformat().replace(":", "-").replace(".", "-")
-    concat_txt_path = os.path.join(FINAL_DIR, f"concat_{timestamp}.txt")
-    joined_video_path = os.path.join(FINAL_DIR, f"joined_{timestamp}.mp4")
-    temp_audio_path = os.path.join(FINAL_DIR, f"audio_{timestamp}.mp3")
+    joined_video_path = os.path.join(WORK_DIR, f"joined_{timestamp}.mp4")
     output_video_basename = request_data.output_filename if request_data.output_filename else f"final_reel_{uuid.uuid4()}.mp4"
     final_video_path = os.path.join(FINAL_DIR, output_video_basename)
 
     # Add files to cleanup
-    files_to_delete = [concat_txt_path, joined_video_path]
-    if request_data.audio_url:
-        files_to_delete.append(temp_audio_path)
+    files_to_delete = [joined_video_path]
     files_to_delete.append(final_video_path) # Always clean up final output
     
     # NOTE: If clips in request_data.clips are local files created by generate-clip,
@@ -263,46 +897,78 @@ async def join_clips_endpoint(request_data: ProcessClipsRequest, background_task
     # is run separately. For a robust system, track files with unique IDs or a dedicated
     # cleanup service.
 
-    background_tasks.add_task(delete_files, files_to_delete, delay=3600)
-    logger.info(f"Scheduled cleanup for {files_to_delete}")
+    schedule_delete(files_to_delete)
 
     try:
-        # 1. Create a concat file listing all clips for FFmpeg concatenation
-        logger.info(f"Creating concat list file: {concat_txt_path}")
-        with open(concat_txt_path, "w") as f:
-            for clip_info in request_data.clips:
-                if not os.path.exists(clip_info.filename):
-                    logger.error(f"Input clip file not found: {clip_info.filename}")
-                    raise HTTPException(status_code=404, detail=f"Input clip file not found: {clip_info.filename}")
-                f.write(f"file '{clip_info.filename}'\n")
-        logger.info("Concat list file created.")
-
-        # 2. Concatenate clips using FFmpeg's concat demuxer
-        concat_cmd = ["-f", "concat", "-safe", "0", "-i", concat_txt_path, "-c", "copy", joined_video_path]
-        await run_ffmpeg_command(concat_cmd)
+        # 1. Build the concat list in memory; it's fed to ffmpeg over stdin so
+        # there's no temp file to write, fsync or clean up afterwards. Probe
+        # every input first: `-c copy` concat silently produces a broken file
+        # when codec parameters differ between clips, so mismatches are
+        # rejected up front.
+        reference_params = None
+        for clip_info in request_data.clips:
+            # A quote would terminate the concat-list entry early and splice
+            # the rest of the name into the list syntax.
+            if "'" in clip_info.filename:
+                logger.error(f"Rejected clip filename containing a quote: {clip_info.filename}")
+                raise HTTPException(status_code=422, detail="Clip filenames must not contain single quotes")
+            if not os.path.exists(clip_info.filename):
+                logger.error(f"Input clip file not found: {clip_info.filename}")
+                raise HTTPException(status_code=404, detail=f"Input clip file not found: {clip_info.filename}")
+            params = await probe_stream_params(clip_info.filename)
+            if reference_params is None:
+                reference_params = params
+            elif params != reference_params:
+                logger.error(f"Clip {clip_info.filename} has mismatched stream params: {params} != {reference_params}")
+                raise HTTPException(
+                    status_code=422,
+                    detail=f"Clip {clip_info.filename} does not match the codec parameters of the first clip; stream-copy concat would produce a broken file."
+                )
+        # Entries need an explicit file: protocol and absolute path — the
+        # concat demuxer resolves bare names relative to the list's own URL,
+        # which for a stdin-fed list is pipe:, so they would never open.
+        concat_list = "".join(
+            f"file 'file:{os.path.abspath(clip_info.filename)}'\n"
+            for clip_info in request_data.clips
+        )
+
+        # 2. Concatenate clips using FFmpeg's concat demuxer, list piped on stdin
+        concat_cmd = [
+            "-f", "concat", "-safe", "0",
+            "-protocol_whitelist", "file,pipe",
+            "-i", "pipe:0",
+            "-c", "copy",
+            "-movflags", "+faststart", # Moov up front even on the remux path
+            joined_video_path
+        ]
+        await run_ffmpeg_command(concat_cmd, input_data=concat_list.encode())
         logger.info(f"Clips concatenated to: {joined_video_path}")
 
         current_video_input_path = joined_video_path
         
         # 3. Handle audio (voice-over)
         if request_data.audio_url:
-            logger.info(f"Downloading audio from {request_data.audio_url} to {temp_audio_path}")
-            async with httpx.AsyncClient() as client:
-                response = await client.get(request_data.audio_url)
-                response.raise_for_status()
-                with open(temp_audio_path, "wb") as f:
-                    f.write(response.content)
-            logger.info(f"Audio downloaded successfully to {temp_audio_path}. File size: {os.path.getsize(temp_audio_path)} bytes.")
-
-            # Mix video's original audio with voice-over audio
+            logger.info(f"Mixing voice-over audio from {request_data.audio_url}")
+
+            # Clips generated by this service are video-only, so the common
+            # case just muxes the voice-over in; amix only runs when the
+            # joined video actually has an audio track ([0:a] on a file
+            # without one makes ffmpeg abort). ffmpeg streams the audio
+            # input over HTTP itself, overlapping fetch with the mux/mix.
+            if await has_audio_stream(current_video_input_path):
+                audio_args = [
+                    "-filter_complex", "[0:a][1:a]amix=inputs=2:duration=longest[aout]",
+                    "-map", "0:v", "-map", "[aout]",
+                ]
+            else:
+                audio_args = ["-map", "0:v", "-map", "1:a"]
             amix_cmd = [
                 "-i", current_video_input_path,
-                "-i", temp_audio_path,
-                "-filter_complex", "[0:a][1:a]amix=inputs=2:duration=longest[aout]",
-                "-map", "0:v",
-                "-map", "[aout]",
-                "-c:v", "copy",
+                "-i", request_data.audio_url,
+                *audio_args,
+                "-c:v", "copy", # Video is remuxed untouched; only audio re-encodes
                 "-c:a", "aac", "-b:a", "192k",
+                "-movflags", "+faststart",
                 final_video_path # Output to final path immediately
             ]
             await run_ffmpeg_command(amix_cmd)
@@ -313,54 +979,58 @@ async def join_clips_endpoint(request_data: ProcessClipsRequest, background_task
             # We'll explicitly copy it to final_video_path if no further processing happens.
             pass
 
-        # 4. Add captions (if any) using drawtext filter
+        # 4. Add captions (if any) using the subtitles filter. One libass
+        # renderer handles every caption, where the old per-caption drawtext
+        # chain rasterized N text layers on every frame even though at most
+        # one was visible. The SRT also sidesteps escaping user text into
+        # filter syntax.
         if request_data.captions:
-            subtitled_video_path = final_video_path # Assume final_video_path is the base, re-assign if needed
-            
-            # If audio was mixed, current_video_input_path is already final_video_path.
-            # If no audio was mixed, current_video_input_path is joined_video_path.
-            # We need to ensure the audio stream from the current input is mapped.
-            
-            # Build drawtext filter chain
-            drawtext_filters = []
-            for i, caption in enumerate(request_data.captions):
-                # Escape single quotes and backslashes for FFmpeg string
-                escaped_text = caption.text.replace("'", "'\\''").replace("\\", "\\\\")
-                
-                drawtext_filters.append(
-                    f"drawtext=text='{escaped_text}':x=(w-text_w)/2:y=h-50:fontsize=48:fontcolor=white:borderw=2:bordercolor=black:enable='between(t,{caption.start_time},{caption.end_time})'"
-                )
-            
-            # Chain multiple drawtext filters
-            # [0:v] refers to the video stream from the first input (current_video_input_path)
-            # [0:a] refers to the audio stream from the first input (current_video_input_path)
-            complex_filter_chain = f"[0:v]{drawtext_filters[0]}[vtemp0]"
-            for i in range(1, len(drawtext_filters)):
-                complex_filter_chain += f";[vtemp{i-1}]{drawtext_filters[i]}[vtemp{i}]"
-            
-            # Final output from the filter chain
-            final_video_stream = f"[vtemp{len(drawtext_filters)-1}]"
+            srt_path = os.path.join(WORK_DIR, f"captions_{timestamp}.srt")
+            async with aiofiles.open(srt_path, "w") as f:
+                await f.write(build_srt(request_data.captions))
+
+            subtitles_filter = (
+                f"subtitles=filename={srt_path}"
+                f":force_style='Fontsize=48,PrimaryColour=&Hffffff&,OutlineColour=&H000000&,Outline=2'"
+            )
 
+            # Output to scratch first: when audio was mixed,
+            # current_video_input_path already IS final_video_path, and ffmpeg
+            # cannot read and write the same file in one pass.
+            subtitled_video_path = os.path.join(WORK_DIR, f"subtitled_{timestamp}.mp4")
             caption_cmd = [
                 "-i", current_video_input_path, # This input has the video (and potentially mixed audio)
-                "-filter_complex", complex_filter_chain,
-                "-map", final_video_stream, # Map the final video stream from the filter_complex
-                "-map", "0:a", # Map the audio stream from the input
-                "-c:v", "libx264", "-preset", "medium", "-crf", "23", # Re-encode video
+                "-vf", subtitles_filter,
+                *video_codec_args(), # Re-encode video (NVENC when available)
                 "-c:a", "aac", "-b:a", "192k", # Encode audio
-                subtitled_video_path # Output to the subtitled path
+                "-movflags", "+faststart",
+                subtitled_video_path
             ]
-            await run_ffmpeg_command(caption_cmd)
-            logger.info(f"Captions added and output to: {subtitled_video_path}")
-            final_video_path = subtitled_video_path # Update the final path
+            try:
+                await run_ffmpeg_command(caption_cmd)
+            finally:
+                os.remove(srt_path) # Only needed for the one render pass, even when it fails
+            # Worker thread: scratch is usually tmpfs, so this move is a full
+            # cross-filesystem copy of the finished video.
+            await asyncio.to_thread(shutil.move, subtitled_video_path, final_video_path)
+            logger.info(f"Captions added and output to: {final_video_path}")
 
         # 5. Finalize the video path if no audio/captions steps changed it
         if not request_data.audio_url and not request_data.captions:
-            # If no audio mixing or captions were applied, the joined_video_path is the final product.
-            # We need to copy it to the designated final_video_path.
+            # If no audio mixing or captions were applied, the joined_video_path
+            # is the final product. Hardlink it into place (constant time, no
+            # byte copy — both names share one inode and unlink independently);
+            # when the link fails (WORK_DIR on tmpfs is a different filesystem
+            # from static/, so this is the usual case) fall back to a worker-
+            # thread copy. copyfile uses the kernel fast paths internally and
+            # unlike a raw sendfile call handles short writes, and to_thread
+            # keeps the multi-MB copy off the event loop.
             if joined_video_path != final_video_path: # Ensure we don't copy if it's already the same
-                shutil.copy(joined_video_path, final_video_path)
-            logger.info(f"No additional processing, final video is copied from joined clips: {final_video_path}")
+                try:
+                    os.link(joined_video_path, final_video_path)
+                except OSError:
+                    await asyncio.to_thread(shutil.copyfile, joined_video_path, final_video_path)
+            logger.info(f"No additional processing, final video is linked from joined clips: {final_video_path}")
 
 
         # Final check if the output video was created
@@ -372,15 +1042,40 @@ async def join_clips_endpoint(request_data: ProcessClipsRequest, background_task
         logger.info(f"Successfully processed clips. Response: {response_payload}")
         return response_payload
 
-    except httpx.HTTPStatusError as e:
-        logger.error(f"HTTP error during audio download: {e.response.status_code} - {e.response.text}", exc_info=True)
-        raise HTTPException(status_code=e.response.status_code, detail=f"Failed to download audio from URL: {e.response.status_code} - {e.response.text}")
     except HTTPException: # Re-raise FastAPI HTTPExceptions
         raise
     except Exception as e:
         logger.exception(f"An unhandled error occurred during clip processing: {e}")
         raise HTTPException(status_code=500, detail=f"An internal server error occurred during clip processing: {e}")
 
+# --- Media Serving ---
+# When fronted by nginx, set USE_X_ACCEL_REDIRECT=1 and configure:
+#   location /internal/ { internal; alias <app dir>/static/; }
+# nginx then sendfile(2)s the video straight from the kernel, freeing this
+# worker immediately. Without nginx the route falls back to FileResponse.
+USE_X_ACCEL_REDIRECT = os.environ.get("USE_X_ACCEL_REDIRECT", "").lower() in ("1", "true", "yes")
+
+
+@app.get("/media/{folder}/{filename}", summary="Serve a generated video file")
+async def serve_media(folder: str, filename: str):
+    """
+    Serves a generated video, delegating the byte transfer to nginx via
+    X-Accel-Redirect when available.
+    """
+    if folder not in ("clips", "final") or filename != os.path.basename(filename):
+        raise HTTPException(status_code=404, detail="File not found")
+    file_path = os.path.join("static", folder, filename)
+    if not os.path.isfile(file_path):
+        raise HTTPException(status_code=404, detail="File not found")
+
+    if USE_X_ACCEL_REDIRECT:
+        return Response(headers={
+            "X-Accel-Redirect": f"/internal/{folder}/{filename}",
+            "Content-Type": "video/mp4",
+        })
+    return FileResponse(file_path, media_type="video/mp4")
+
+
 # Root endpoint
 @app.get("/", summary="Root endpoint")
 async def read_root():